@@ -13,6 +13,25 @@ from astropy.cosmology import Planck15 as cosmo
 from . import utilities, plot, sncosmo_spectral_v13
 from lmfit import Model, Parameters, Minimizer, report_fit, minimize
 
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+
+        return decorator
+
+
+@njit(cache=True, fastmath=True)
+def _powerlaw_residual(alpha, scale, nu, data):
+    """
+    AB magnitude residual of a powerlaw evaluated at the frequencies nu. Written
+    as an array expression so it is fast with and without numba
+    """
+    return -2.5 * np.log10(scale * nu ** alpha) - 48.6 - data
+
 
 class FitSpectrum:
     """ """
@@ -28,13 +47,17 @@ class FitSpectrum:
     ):
 
         self.fittype = fittype
-        self.binned_lc_df = binned_lc_df
         self.redshift = redshift
         self.plot = plot
         self.fit_algorithm = fit_algorithm
         self.filter_wl = utilities.load_info_json("filter_wl")
         self.wavelengths = np.arange(1000, 60000, 10) * u.AA
         self.frequencies = const.c.value / (self.wavelengths.value * 1e-10) * u.Hz
+        self.set_data(binned_lc_df)
+
+    def set_data(self, binned_lc_df):
+        """ Set the binned lightcurve to fit, so one instance can be reused """
+        self.binned_lc_df = binned_lc_df
 
     def fit_global_parameters(self, min_datapoints: int = 4, **kwargs):
         """ """
@@ -46,22 +69,10 @@ class FitSpectrum:
         bands = set()
 
         df = self.binned_lc_df
-        reduced_df = pd.DataFrame(
-            columns=[
-                "telescope_band",
-                "wavelength",
-                "mean_obsmjd",
-                "entries",
-                "mean_mag",
-                "mean_mag_err",
-            ]
+        reduced_df = df.groupby("mean_obsmjd", sort=False).filter(
+            lambda group: group.telescope_band.nunique() >= min_datapoints
         )
-
-        for mean_obsmjd in df.mean_obsmjd.unique():
-            _df = df.query(f"mean_obsmjd == {mean_obsmjd}")
-            binsize = len(_df.telescope_band.unique())
-            if binsize >= min_datapoints:
-                reduced_df = reduced_df.append(_df, ignore_index=True)
+        reduced_df = reduced_df.reset_index(drop=True)
 
         mean_flux = utilities.abmag_to_flux(reduced_df.mean_mag.values)
         mean_flux_err = utilities.abmag_err_to_flux_err(
@@ -77,13 +88,11 @@ class FitSpectrum:
         data = []
         data_err = []
 
-        for mjd in reduced_df.mean_obsmjd.unique():
+        for mjd, group in reduced_df.groupby("mean_obsmjd", sort=False):
             fluxes = []
             flux_errs = []
             for telescope_band in bands_to_fit:
-                _df = reduced_df.query(
-                    f"telescope_band == '{telescope_band}' and mean_obsmjd == '{mjd}'"
-                )
+                _df = group[group.telescope_band == telescope_band]
                 print(_df)
                 flux = _df.mean_flux.values[0]
                 flux_err = _df.mean_flux_err.values[0]
@@ -232,38 +241,58 @@ class FitSpectrum:
                 extinction_rv_err = None
 
         df = self.binned_lc_df
-        mean_flux = utilities.abmag_to_flux(df.mean_mag.values)
-        mean_flux_err = utilities.abmag_err_to_flux_err(
-            df.mean_mag.values, df.mean_mag_err.values
-        )
+
+        # Extract the arrays once, everything below works on these
+        wl_observed = df.wavelength.to_numpy()
+        data = df.mean_mag.to_numpy()
+        data_err = df.mean_mag_err.to_numpy()
+        mjd = df.mean_obsmjd.to_numpy()[0]
+
+        mean_flux = utilities.abmag_to_flux(data)
+        mean_flux_err = utilities.abmag_err_to_flux_err(data, data_err)
         df.insert(len(df.columns), "mean_flux", mean_flux)
         df.insert(len(df.columns), "mean_flux_err", mean_flux_err)
 
         cmap = utilities.load_info_json("cmap")
         bands_to_fit = df.telescope_band.unique()
 
+        # Optional starting values (e.g. the result of the previous bin)
+        initial_params = kwargs.get("initial_params") or {}
+
         params = Parameters()
 
+        def add_param(name, value, lower, upper):
+            start = initial_params.get(name)
+            if start is not None and np.isfinite(start):
+                value = float(np.clip(start, lower, upper))
+            params.add(name, value=value, min=lower, max=upper)
+
         if self.fittype == "powerlaw":
-            params.add("scale", value=1e-14, min=1e-20, max=1e-8)
+            add_param("scale", value=1e-14, lower=1e-20, upper=1e-8)
             if alpha is None:
-                params.add("alpha", value=-0.9, min=-1.2, max=-0.1)
+                add_param("alpha", value=-0.9, lower=-1.2, upper=-0.1)
         if self.fittype == "blackbody":
-            params.add("temp", value=10000, min=100, max=150000)
-            params.add("scale", value=1e23, min=1e18, max=1e27)
+            add_param("temp", value=10000, lower=100, upper=150000)
+            add_param("scale", value=1e23, lower=1e18, upper=1e27)
         else:
             print("please provide a fittype (at the moment: powerlaw or blackbody)")
 
-        wl_observed = np.asarray(df.wavelength.values)
-        data = np.asarray(df.mean_mag.values)
-        data_err = np.asarray(df.mean_mag_err.values)
-
         if self.fittype == "powerlaw":
             if alpha is not None:
                 fcn_kws = {"alpha": alpha}
             else:
                 fcn_kws = {}
             minimizer_fcn = self._powerlaw_minimizer
+            # The model is evaluated at the first grid wavelength redward of each
+            # band, so we can look up these frequencies once for the whole fit
+            grid_index = np.minimum(
+                np.searchsorted(self.wavelengths.value, wl_observed, side="right"),
+                len(self.wavelengths) - 1,
+            )
+            fcn_args = (
+                self.frequencies.value[grid_index],
+                np.asarray(data, dtype=np.float64),
+            )
 
         if self.fittype == "blackbody":
             fcn_kws = {
@@ -272,12 +301,13 @@ class FitSpectrum:
                 "redshift": self.redshift,
             }
             minimizer_fcn = self._blackbody_minimizer
+            fcn_args = (wl_observed, [data])
 
         else:
             print("please provide a fittype (at the moment: powerlaw or blackbody)")
 
         minimizer = Minimizer(
-            minimizer_fcn, params, fcn_args=(wl_observed, [data]), fcn_kws=fcn_kws,
+            minimizer_fcn, params, fcn_args=fcn_args, fcn_kws=fcn_kws,
         )
 
         out = minimizer.minimize(method=self.fit_algorithm)
@@ -334,7 +364,7 @@ class FitSpectrum:
         if self.plot:
             if self.fittype == "powerlaw":
                 annotations = {
-                    "mjd": df["mean_obsmjd"].values[0],
+                    "mjd": mjd,
                     "scale": parameters["scale"],
                     "scale_err": out.params["scale"].stderr,
                     "reduced_chisquare": red_chisq,
@@ -353,7 +383,7 @@ class FitSpectrum:
 
             else:
                 annotations = {
-                    "mjd": df["mean_obsmjd"].values[0],
+                    "mjd": mjd,
                     "temperature": parameters["temp"],
                     "scale": parameters["scale"],
                     "reduced_chisquare": red_chisq,
@@ -378,7 +408,7 @@ class FitSpectrum:
             returndict = {
                 "scale": parameters["scale"],
                 "scale_err": out.params["scale"].stderr,
-                "mjd": df["mean_obsmjd"].values[0],
+                "mjd": mjd,
                 "red_chisq": red_chisq,
                 "red_chisq_binfit": out.redchi,
                 "luminosity_uv_optical": luminosity_uv_optical.value,
@@ -402,7 +432,7 @@ class FitSpectrum:
                 "extinction_av_err": extinction_av_err,
                 "extinction_rv": extinction_rv,
                 "extinction_rv_err": extinction_rv_err,
-                "mjd": df["mean_obsmjd"].values[0],
+                "mjd": mjd,
                 "red_chisq": red_chisq,
                 "red_chisq_binfit": out.redchi,
                 "luminosity_uv_optical": luminosity_uv_optical.value,
@@ -439,12 +469,10 @@ class FitSpectrum:
         df.insert(len(df.columns), "residual", df.mag_model - df.mean_mag)
 
         # Calculate reduced chisquare
-        chisquare = 0
-
-        for index, mag_model in enumerate(list(df.mag_model.values)):
-            chisquare += (mag_model - list(df.mean_mag.values)[index]) ** 2 / list(
-                df.mean_mag_err.values
-            )[index] ** 2
+        chisquare = np.sum(
+            (df.mag_model.to_numpy() - df.mean_mag.to_numpy()) ** 2
+            / df.mean_mag_err.to_numpy() ** 2
+        )
 
         dof = len(df.mag_model) - 2
 
@@ -511,53 +539,14 @@ class FitSpectrum:
             return ab_model_list
 
     @staticmethod
-    def _powerlaw_minimizer(params, x, data=None, **kwargs):
-        """ """
-        filter_wl = utilities.load_info_json("filter_wl")
-        wl_filter = {v: k for k, v in filter_wl.items()}
-
-        if "alpha" in kwargs:
-            alpha = kwargs["alpha"]
-        else:
-            alpha = params["alpha"]
-
-        if "scale" in params.keys():
-            scale = params["scale"]
-        else:
-            scale = None
-
-        if "redshift" in params.keys():
-            redshift = params["redshift"]
-        else:
-            redshift = None
-
-        spectrum = utilities.powerlaw_spectrum(
-            alpha=alpha, scale=scale, redshift=redshift
-        )
-
-        ab_model_list = []
-        flux_list = []
-
-        for wl in x:
-            # ab_model = utilities.magnitude_in_band(wl_filter[wl], spectrum)
-            for index, _wl in enumerate(spectrum.wave):
-                if _wl > wl:
-                    ab_model = utilities.flux_to_abmag(spectrum.flux[index])
-                    break
-            flux = utilities.abmag_to_flux(ab_model)
-            ab_model_list.append(ab_model)
-            flux_list.append(flux)
-
-        if "flux" in kwargs.keys():
-            if data:
-                return np.asarray(flux_list) - np.asarray(data)
-            else:
-                return flux_list
-
-        if data:
-            return np.asarray(ab_model_list) - np.asarray(data)
-        else:
-            return ab_model_list
+    def _powerlaw_minimizer(params, nu, data, alpha=None):
+        """
+        Residual of a powerlaw, evaluated at the grid frequencies nu of the
+        observed bands (compiled with numba if it is installed)
+        """
+        if alpha is None:
+            alpha = params["alpha"].value
+        return _powerlaw_residual(float(alpha), params["scale"].value, nu, data)
 
     @staticmethod
     def _global_minimizer(params, x, data=None, data_err=None, **kwargs):
@@ -3,16 +3,50 @@
 # License: BSD-3-Clause
 
 import logging, os, argparse, json
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import astropy.units as u
 from astropy import constants as const
-from astropy.utils.console import ProgressBar
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from .fit import FitSpectrum
 from . import utilities, plot, sncosmo_spectral_v13
 
 
+# Fit parameters that are held fixed in fit_bin and thus change the bin results
+FIXED_FIT_KWARGS = [
+    "alpha",
+    "alpha_err",
+    "extinction_av",
+    "extinction_av_err",
+    "extinction_rv",
+    "extinction_rv_err",
+]
+
+
+def _none_to_nan(result):
+    """
+    orjson writes inf and NaN as null, so turn these back into floats for
+    the plotting functions
+    """
+    return {key: np.nan if value is None else value for key, value in result.items()}
+
+
+@lru_cache(maxsize=None)
+def _get_fitter(fittype, redshift, fit_algorithm):
+    """ One reusable FitSpectrum per worker process and fit configuration """
+    return FitSpectrum(None, fittype, redshift, fit_algorithm=fit_algorithm)
+
+
+def _fit_one_static(binned_lc_df, fittype, redshift, fit_algorithm, kwargs):
+    """ Fit a single bin; module-level so it can be pickled for worker processes """
+    fit = _get_fitter(fittype, redshift, fit_algorithm)
+    fit.set_data(binned_lc_df)
+    return fit.fit_bin(**kwargs)
+
+
 class SED:
     """
         Reads a ZTF lightcurve file, bins the data and fits a predefined model to each epoch SED.
@@ -57,6 +91,13 @@ class SED:
 
         self.cmap = utilities.load_info_json("cmap")
         self.filter_wl = utilities.load_info_json("filter_wl")
+        self._all_bands = list(self.filter_wl.keys())
+        self._fitter = FitSpectrum(
+            None,
+            fittype=self.fittype,
+            redshift=self.redshift,
+            fit_algorithm=self.fit_algorithm,
+        )
 
         self.read_lightcurve()
         print(
@@ -70,8 +111,8 @@ class SED:
 
     def fit_one_bin(self, binned_lc_df, **kwargs):
         """ """
-        fit = FitSpectrum(binned_lc_df, self.fittype, self.redshift, self.fit_algorithm)
-        fitresult = fit.fit_bin(**kwargs)
+        self._fitter.set_data(binned_lc_df)
+        fitresult = self._fitter.fit_bin(**kwargs)
 
         return fitresult
 
@@ -84,6 +125,7 @@ class SED:
     ):
         """ """
         lc = self.lc
+        filter_wl = self.filter_wl
 
         mjds = lc.obsmjd.values
         mjd_min = np.min(mjds)
@@ -92,7 +134,7 @@ class SED:
         mjd_iter = np.linspace(mjd_min, mjd_max, num=self.nbins + 1)
 
         if bands is None:
-            bands_to_fit = list(self.filter_wl.keys())
+            bands_to_fit = self._all_bands
         else:
             bands_to_fit = bands
 
@@ -106,66 +148,69 @@ class SED:
         lc.reset_index(inplace=True)
         lc = lc.drop(columns=["index"])
 
-        temp_df = pd.DataFrame()
+        columns = [
+            "telescope_band",
+            "wavelength",
+            "mean_obsmjd",
+            "entries",
+            "mean_mag",
+            "mean_mag_err",
+        ]
 
         if not bins_from_df:
-            for index, mjd in enumerate(mjd_iter):
-                if index != len(mjd_iter) - 1:
-                    df = lc.query(
-                        f"obsmjd >= {mjd_iter[index]} and obsmjd < {mjd_iter[index+1]}"
-                    )
-                    for telescope_band in df.telescope_band.unique():
-                        _df = df.query("telescope_band == @telescope_band")
-                        mean_mag = np.mean(_df["mag"].values)
-                        mean_mag_err = np.mean(_df["mag_err"].values)
-                        entries = len(_df["mag"].values)
-                        mean_obsmjd = np.mean([mjd_iter[index], mjd_iter[index + 1]])
-                        wavelength = self.filter_wl[telescope_band]
-                        temp_df = temp_df.append(
-                            {
-                                "telescope_band": telescope_band,
-                                "wavelength": wavelength,
-                                "mean_obsmjd": mean_obsmjd,
-                                "entries": entries,
-                                "mean_mag": mean_mag,
-                                "mean_mag_err": mean_mag_err,
-                            },
-                            ignore_index=True,
-                        )
+            # Assign every datapoint to its time bin in one pass, the last
+            # edge is folded into the final bin
+            bin_index = np.clip(
+                np.searchsorted(mjd_iter, lc.obsmjd.values, side="right") - 1,
+                0,
+                self.nbins - 1,
+            )
+            lc = lc.assign(_bin=bin_index)
+            agg = (
+                lc.groupby(["_bin", "telescope_band"], observed=True)
+                .agg(
+                    mean_mag=("mag", "mean"),
+                    mean_mag_err=("mag_err", "mean"),
+                    entries=("mag", "size"),
+                )
+                .reset_index()
+            )
+            bin_values = agg._bin.values
+            agg["mean_obsmjd"] = 0.5 * (mjd_iter[bin_values] + mjd_iter[bin_values + 1])
+            agg["wavelength"] = agg.telescope_band.map(filter_wl).astype(float)
+            temp_df = agg[columns]
 
         else:
-            bins = lc.bin.unique()
-            for index in bins:
-                df = lc.query(f"bin == {index}")
-                mean_obsmjd = np.mean(df["obsmjd"].values)
-                for telescope_band in df.telescope_band.unique():
-                    _df = df.query("telescope_band == @telescope_band")
-                    mean_mag = np.mean(_df["mag"].values)
-                    mean_mag_err = np.mean(_df["mag_err"].values)
-                    entries = len(_df["mag"].values)
-                    # mean_obsmjd = np.mean(_df["obsmjd"].values)
-                    wavelength = self.filter_wl[telescope_band]
-                    temp_df = temp_df.append(
-                        {
-                            "telescope_band": telescope_band,
-                            "wavelength": wavelength,
-                            "mean_obsmjd": mean_obsmjd,
-                            "entries": entries,
-                            "mean_mag": mean_mag,
-                            "mean_mag_err": mean_mag_err,
-                        },
-                        ignore_index=True,
-                    )
-
-        result_df = pd.DataFrame()
+            agg = (
+                lc.groupby(["bin", "telescope_band"], observed=True)
+                .agg(
+                    mean_mag=("mag", "mean"),
+                    mean_mag_err=("mag_err", "mean"),
+                    entries=("mag", "size"),
+                )
+                .reset_index()
+            )
+            # The epoch of a predefined bin is the mean over all its datapoints
+            agg["mean_obsmjd"] = agg.bin.map(lc.groupby("bin").obsmjd.mean())
+            agg["wavelength"] = agg.telescope_band.map(filter_wl).astype(float)
+            temp_df = agg[columns]
+
+        if temp_df.empty:
+            return temp_df.reset_index(drop=True)
+
+        # Now we apply our min_bands_per_bin and neccessary_bands criteria. In the
+        # presence table each row is a bin and each column a band (True if the bin
+        # has an entry for it), so both criteria reduce to a mask over its rows
+        present = (
+            pd.crosstab(temp_df.mean_obsmjd, temp_df.telescope_band.astype(str)) > 0
+        )
+        has_neccessary = present.reindex(
+            columns=neccessary_bands, fill_value=False
+        ).all(axis=1)
+        mask = has_neccessary & (present.sum(axis=1) >= min_bands_per_bin)
 
-        # Now we apply our min_bands_per_bin and neccessary_bands criteria
-        for mjd in temp_df.mean_obsmjd.unique():
-            _df = temp_df.query(f"mean_obsmjd == {mjd}")
-            if len(_df) >= min_bands_per_bin and set(neccessary_bands).issubset(
-                _df.telescope_band.unique()
-            ):
-                result_df = result_df.append(_df, ignore_index=True)
+        result_df = temp_df[temp_df.mean_obsmjd.isin(present.index[mask])]
+        result_df = result_df.reset_index(drop=True)
 
         return result_df
 
@@ -174,9 +219,37 @@ class SED:
         min_bands_per_bin: float = None,
         neccessary_bands: list = None,
         bins_from_df: bool = False,
+        warm_start: bool = False,
+        warm_start_max_chisq: float = None,
+        resume: bool = False,
+        kmeans_seed: bool = False,
+        kmeans_max_clusters: int = 8,
+        max_workers: int = None,
         **kwargs,
     ):
-        """" """
+        """
+        When warm_start is True, the bins are fitted sequentially in time and each
+        fit starts from the best-fit parameters of the previous bin. If the reduced
+        chisquare of a bin exceeds warm_start_max_chisq, the next bin starts from
+        the default parameters again.
+
+        Each result is appended to a jsonl file as soon as it is available. With
+        resume=True, bins already present in that file (e.g. from a crashed run)
+        are not fitted again, provided the binning, bands and fixed fit
+        parameters are the same as in that run.
+
+        With kmeans_seed=True, the bin SEDs are clustered first (needs scikit-learn)
+        into min(kmeans_max_clusters, number of bins // 5) clusters, but at least one.
+        The mean SED of each cluster is fitted once and each bin fit starts from
+        the result of its cluster.
+
+        Without warm_start, the bins are fitted in parallel with max_workers
+        processes (default: one per core). With max_workers=1, or if only one bin
+        needs fitting, everything runs in the current process.
+        """
+
+        if warm_start and kmeans_seed:
+            raise ValueError("Choose either warm_start or kmeans_seed, not both")
 
         print(f"Fitting {self.nbins} time bins.\n")
 
@@ -189,7 +262,7 @@ class SED:
             if min_bands_per_bin is None:
                 min_bands_per_bin = 2
             print(f"Fitting all bands")
-            bands = binned_lc_df.telescope_band.unique()
+            bands = None
 
         if not neccessary_bands:
             neccessary_bands = []
@@ -211,20 +284,204 @@ class SED:
             bins_from_df=bins_from_df,
         )
 
-        fitparams = {}
+        groups = list(binned_lc_df.groupby("mean_obsmjd", sort=True))
+        mjds = [mjd for mjd, _df in groups]
+        tasks = [_df for mjd, _df in groups]
+
+        outfile_path = os.path.join(self.fit_dir, f"{self.fittype}.json")
+        partial_path = os.path.join(self.fit_dir, f"{self.fittype}.jsonl")
+
+        # Results in the jsonl file can only be reused if they were obtained
+        # with the same binning and the same fixed fit parameters
+        header = {
+            "fittype": self.fittype,
+            "nbins": self.nbins,
+            "bands": None if bands is None else list(bands),
+            "min_bands_per_bin": min_bands_per_bin,
+            "neccessary_bands": list(neccessary_bands),
+            "bins_from_df": bins_from_df,
+            "fit_kwargs": {
+                key: kwargs[key] for key in FIXED_FIT_KWARGS if key in kwargs
+            },
+        }
+
+        results = {}
+
+        if resume and os.path.exists(partial_path):
+            entries = utilities.load_json_lines(partial_path)
+            if (
+                entries
+                and "header" in entries[0]
+                and utilities.dumps_json(entries[0]["header"])
+                == utilities.dumps_json(header)
+            ):
+                for entry in entries[1:]:
+                    index = entry["bin"]
+                    # mjds survive the json round trip exactly
+                    if index < len(mjds) and entry["mjd"] == mjds[index]:
+                        results[index] = entry["result"]
+                print(f"Resuming, {len(results)} bins have already been fitted")
+            else:
+                print("Fit settings have changed, not reusing previous results")
+
+        # Start a fresh file with only the entries we keep, so a line cut off by
+        # a crash can never get merged with the next result
+        with open(partial_path, "w") as partial_file:
+            utilities.append_json_line(partial_file, {"header": header})
+            for index in sorted(results):
+                utilities.append_json_line(
+                    partial_file,
+                    {"bin": index, "mjd": mjds[index], "result": results[index]},
+                )
+
+        if kmeans_seed:
+            seeds = self._kmeans_initial_params(
+                tasks, max_clusters=kmeans_max_clusters, **kwargs
+            )
+            task_kwargs = [dict(kwargs, initial_params=seed) for seed in seeds]
+        else:
+            task_kwargs = [kwargs] * len(tasks)
+
+        if max_workers is None:
+            max_workers = os.cpu_count()
+
+        pending = [index for index in range(len(tasks)) if index not in results]
+
+        with open(partial_path, "a") as partial_file:
+
+            def store_result(index, result):
+                results[index] = result
+                utilities.append_json_line(
+                    partial_file, {"bin": index, "mjd": mjds[index], "result": result}
+                )
+
+            if warm_start:
+                # Adjacent bins are similar, so each fit starts where the last ended
+                bin_kwargs = dict(kwargs)
+                for index, _df in enumerate(tqdm(tasks)):
+                    if index in results:
+                        result = results[index]
+                    else:
+                        result = self.fit_one_bin(binned_lc_df=_df, **bin_kwargs)
+                        store_result(index, result)
+                    # A missing chisquare (inf or NaN are stored as null) also resets
+                    red_chisq = result["red_chisq"]
+                    if warm_start_max_chisq is not None and (
+                        red_chisq is None or not red_chisq <= warm_start_max_chisq
+                    ):
+                        bin_kwargs.pop("initial_params", None)
+                    else:
+                        bin_kwargs["initial_params"] = (
+                            self._initial_params_from_result(result)
+                        )
 
-        progress_bar = ProgressBar(len(binned_lc_df.mean_obsmjd.unique()))
+            elif max_workers == 1 or len(pending) <= 1:
+                for index in tqdm(pending, total=len(tasks), initial=len(results)):
+                    store_result(
+                        index,
+                        self.fit_one_bin(
+                            binned_lc_df=tasks[index], **task_kwargs[index]
+                        ),
+                    )
 
-        for index, mjd in enumerate(binned_lc_df.mean_obsmjd.unique()):
-            _df = binned_lc_df.query(f"mean_obsmjd == {mjd}")
-            result = self.fit_one_bin(binned_lc_df=_df, **kwargs)
-            fitparams.update({index: result})
-            progress_bar.update(index)
+            else:
+                # Each bin is an independent fit, so we distribute them over all cores
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(
+                            _fit_one_static,
+                            tasks[index],
+                            self.fittype,
+                            self.redshift,
+                            self.fit_algorithm,
+                            task_kwargs[index],
+                        ): index
+                        for index in pending
+                    }
+                    # Keep storing the bins that succeed, so a failing bin does
+                    # not throw away the work of the others (see resume)
+                    errors = []
+                    for future in tqdm(
+                        as_completed(futures), total=len(tasks), initial=len(results)
+                    ):
+                        try:
+                            result = future.result()
+                        except Exception as error:
+                            errors.append(error)
+                            continue
+                        store_result(futures[future], result)
+                    if errors:
+                        raise errors[0]
+
+        fitparams = {index: results[index] for index in range(len(tasks))}
+
+        # Write to a temporary file first, so a crash never leaves a partial json
+        utilities.dump_json(fitparams, outfile_path + ".tmp")
+        os.replace(outfile_path + ".tmp", outfile_path)
+        os.remove(partial_path)
+
+    def _kmeans_initial_params(self, tasks, max_clusters: int = 8, **kwargs):
+        """
+        Cluster the bin SEDs with k-means, fit the mean SED of every cluster and
+        return the resulting starting parameters for each bin
+        """
+        if not tasks:
+            return []
+
+        from sklearn.cluster import MiniBatchKMeans
+
+        binned_lc_df = pd.concat(tasks, ignore_index=True)
+        binned_lc_df["telescope_band"] = binned_lc_df.telescope_band.astype(str)
+
+        # One row per bin, one column per band. For the clustering only, missing
+        # bands get the band median
+        raw_mags = binned_lc_df.pivot_table(
+            index="mean_obsmjd", columns="telescope_band", values="mean_mag"
+        )
+        mags = raw_mags.fillna(raw_mags.median())
+        mag_errs = binned_lc_df.pivot_table(
+            index="mean_obsmjd", columns="telescope_band", values="mean_mag_err"
+        )
+
+        n_clusters = max(1, min(max_clusters, len(tasks) // 5))
+        labels = MiniBatchKMeans(n_clusters=n_clusters, random_state=0).fit_predict(
+            mags.values
+        )
+
+        cluster_params = {}
+        for label in np.unique(labels):
+            members = labels == label
+            # The centroid SED only contains bands observed in the member bins
+            mean_mags = raw_mags[members].mean().dropna()
+            bands = mean_mags.index
+            centroid_df = pd.DataFrame(
+                {
+                    "telescope_band": bands,
+                    "wavelength": [self.filter_wl[band] for band in bands],
+                    "mean_obsmjd": np.mean(raw_mags.index[members]),
+                    "entries": members.sum(),
+                    "mean_mag": mean_mags.values,
+                    "mean_mag_err": mag_errs[members].median()[bands].values,
+                }
+            )
+            fit = FitSpectrum(
+                centroid_df,
+                fittype=self.fittype,
+                redshift=self.redshift,
+                plot=False,
+                fit_algorithm=self.fit_algorithm,
+            )
+            cluster_params[label] = self._initial_params_from_result(
+                fit.fit_bin(**kwargs)
+            )
 
-        progress_bar.update(len(binned_lc_df.mean_obsmjd.unique()))
+        return [cluster_params[label] for label in labels]
 
-        with open(os.path.join(self.fit_dir, f"{self.fittype}.json"), "w") as outfile:
-            json.dump(fitparams, outfile)
+    def _initial_params_from_result(self, result):
+        """ Translate a fit_bin result into starting values for the next fit """
+        if self.fittype == "powerlaw":
+            return {"scale": result["scale"], "alpha": result["alpha"]}
+        return {"temp": result["temperature"], "scale": result["scale"]}
 
     def fit_global(self, bins_from_df: bool = False, **kwargs):
         """ """
@@ -264,11 +521,10 @@ class SED:
 
         result = fit.fit_global_parameters(**kwargs)
 
-        with open(
-            os.path.join(self.fit_dir, f"{self.fittype}_global.json"), "w"
-        ) as outfile:
-            json.dump(result, outfile)
-            return result
+        utilities.dump_json(
+            result, os.path.join(self.fit_dir, f"{self.fittype}_global.json")
+        )
+        return result
 
     def plot_lightcurve(self, bands, nufnu=False, **kwargs):
         """" """
@@ -289,25 +545,66 @@ class SED:
         plot.plot_temperature(self.fitparams, **kwargs)
 
     def load_fitparams(self):
-        with open(os.path.join(self.fit_dir, f"{self.fittype}.json")) as json_file:
-            fitparams = json.load(json_file)
-        self.fitparams = fitparams
+        fitparams = utilities.load_json(
+            os.path.join(self.fit_dir, f"{self.fittype}.json")
+        )
+        self.fitparams = {
+            index: _none_to_nan(result) for index, result in fitparams.items()
+        }
 
     def load_global_fitparams(self):
-        with open(
+        fitparams_global = utilities.load_json(
             os.path.join(self.fit_dir, f"{self.fittype}_global.json")
-        ) as json_file:
-            fitparams_global = json.load(json_file)
-        self.fitparams_global = fitparams_global
+        )
+        self.fitparams_global = _none_to_nan(fitparams_global)
 
     def read_lightcurve(self):
         if self.path_to_lightcurve is None:
             self.path_to_lightcurve = os.path.join(self.lc_dir, "full_lc_fp.csv")
 
-        lc = pd.read_csv(self.path_to_lightcurve)
-        lc.drop(columns=["Unnamed: 0"], inplace=True)
+        # Only parse the columns we need (this skips the unnamed index column)
+        columns = [
+            "obsmjd",
+            "mag",
+            "mag_err",
+            "telescope",
+            "band",
+            "telescope_band",
+            "bin",
+        ]
+        dtypes = {
+            "obsmjd": "float64",
+            "telescope": "category",
+            "band": "category",
+            "telescope_band": "category",
+        }
+        header = pd.read_csv(self.path_to_lightcurve, nrows=0).columns
+        usecols = [col for col in columns if col in header]
+
+        try:
+            import pyarrow
+
+            engine = "pyarrow"
+        except ImportError:
+            engine = "c"
+
+        lc = pd.read_csv(
+            self.path_to_lightcurve,
+            engine=engine,
+            usecols=usecols,
+            dtype={col: dtypes[col] for col in usecols if col in dtypes},
+        )
 
         if "telescope_band" not in lc.columns:
-            lc.insert(len(lc.columns), "telescope_band", lc.telescope + "+" + lc.band)
+            telescope_band = (
+                lc.telescope.astype("string")
+                .str.cat(lc.band.astype("string"), sep="+")
+                .astype("category")
+            )
+            lc.insert(len(lc.columns), "telescope_band", telescope_band)
+
+        # float32 is plenty for magnitudes, but the MJD needs double precision
+        lc[["mag", "mag_err"]] = lc[["mag", "mag_err"]].astype("float32")
+        lc["telescope_band"] = lc["telescope_band"].astype("category")
 
         self.lc = lc
@@ -3,6 +3,7 @@
 # License: BSD-3-Clause
 
 import os, json, warnings
+from functools import lru_cache
 import numpy as np
 import astropy.units as u
 from astropy import constants as const
@@ -11,6 +12,11 @@ from extinction import ccm89, apply, remove, calzetti00
 from astropy.modeling.models import BlackBody
 from . import sncosmo_spectral_v13
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 FNU = u.erg / (u.cm ** 2 * u.s * u.Hz)
 FLAM = u.erg / (u.cm ** 2 * u.s * u.AA)
 
@@ -528,7 +534,61 @@ def get_wavelengths_and_frequencies():
     return wavelengths, frequencies
 
 
+@lru_cache(maxsize=None)
 def load_info_json(filename: str):
+    """
+    Load a json from the instrument_data folder. The result is cached and
+    shared between callers, so treat it as read-only
+    """
     with open(os.path.join(INSTRUMENT_DATA_DIR, filename + ".json")) as json_file:
         outfile = json.load(json_file)
     return outfile
+
+
+def dumps_json(obj):
+    """
+    Serialize obj to a json string, using orjson if available (numpy scalars
+    and non-string keys are serialized natively, inf and NaN become null)
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return json.dumps(obj)
+
+
+def dump_json(obj, path: str):
+    """ Write obj to a json file, using orjson if available """
+    with open(path, "w") as outfile:
+        outfile.write(dumps_json(obj))
+
+
+def load_json(path: str):
+    """ Read a json file, using orjson if available """
+    if orjson is not None:
+        with open(path, "rb") as json_file:
+            return orjson.loads(json_file.read())
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def append_json_line(outfile, obj):
+    """ Append obj as one line to an open jsonl file and flush it to disk """
+    outfile.write(dumps_json(obj) + "\n")
+    outfile.flush()
+
+
+def load_json_lines(path: str):
+    """ Read all entries of a jsonl file, skipping lines that cannot be parsed """
+    loads = orjson.loads if orjson is not None else json.loads
+    entries = []
+    with open(path) as json_file:
+        for line in json_file:
+            if not line.strip():
+                continue
+            try:
+                entries.append(loads(line))
+            except ValueError:
+                # e.g. a line that was cut off by a crash
+                continue
+    return entries
@@ -65,6 +65,10 @@ def check_dependencies():
         import pysynphot
     except ImportError:
         install_requires.append("pysynphot")
+    try:
+        import tqdm
+    except ImportError:
+        install_requires.append("tqdm")
 
     return install_requires
 